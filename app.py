@@ -42,62 +42,94 @@ analyze_button = st.button("Analyze Product", type="primary", use_container_widt
 # This is where the output will be displayed
 output_container = st.container()
 
+# --- Results Rendering ---
+def build_display(ai_says_output, formula_breakdown, routine_matches, potential_concerns):
+    """
+    Formats the analysis results into ready-to-paint strings once, so redraws of the
+    results section don't re-sort categories or re-join ingredient lists.
+    """
+    # Don't show a score for the summary
+    assistant_lines = [(f"**{category}:** " + (f"**Score {details['score']}/10**" if details['score'] else ""), details['narrative'])
+                       for category, details in ai_says_output.items()]
+
+    # Sort categories by score to show the most relevant first
+    sorted_categories = sorted(
+        [item for item in ai_says_output.items() if item[0] != "Summary"],
+        key=lambda item: item[1]['score'],
+        reverse=True
+    )
+    # Only show for relevant categories with a score above 3.0, and only non-empty lists
+    breakdown_sections = [
+        (f"**{category_name} (Score: {details['score']}/10)**",
+         [(f"**{list_name}:**", " • " + " • ".join(ingredients)) for list_name, ingredients in formula_breakdown[category_name].items() if ingredients])
+        for category_name, details in sorted_categories
+        if details['score'] > 3.0 and category_name in formula_breakdown
+    ]
+
+    return {
+        "assistant_lines": assistant_lines,
+        "breakdown_sections": breakdown_sections,
+        "potential_concerns": list(potential_concerns or []),
+        "routines_code": "\n".join(routine_matches),
+    }
+
+def render_results(display):
+    st.markdown("---")
+    st.subheader("🤖 AI Assistant Says:")
+    for heading, narrative in display["assistant_lines"]:
+        st.markdown(heading)
+        st.write(narrative)
+
+    st.subheader("🔬 Formula Effectiveness Breakdown:")
+    for title, lists in display["breakdown_sections"]:
+        with st.expander(title):
+            for list_heading, ingredients_line in lists:
+                st.markdown(list_heading)
+                st.write(ingredients_line)
+
+    # Display Potential Concerns if any were found
+    if display["potential_concerns"]:
+        st.subheader("⚠️ Potential Concerns & Usage Notes:")
+        for concern in display["potential_concerns"]:
+            st.warning(concern)
+
+
+    st.subheader("📋 Routine Placements (Internal Use):")
+    if display["routines_code"]:
+        st.code(display["routines_code"], language=None)
+    else:
+        st.info("No perfect routine placements were found based on the analysis.")
+
+
 # --- Main Workflow ---
 if analyze_button:
+    # A new analysis replaces the previous results, even if it ends up producing none.
+    st.session_state.pop("last_display", None)
     if not product_name or not inci_list_str:
         st.warning("Please provide both a product name and an ingredient list.")
     else:
         with st.spinner("🤖 AI is analyzing the formula... This may take a moment."):
             try:
                 # MODIFIED: Function call now unpacks the new 'potential_concerns' variable
-                ai_says_output, formula_breakdown, routine_matches, potential_concerns = engine.run_full_analysis(
+                ai_says_output, formula_breakdown, routine_matches, potential_concerns, debug_log = engine.run_full_analysis(
                     product_name,
                     inci_list_str,
                     known_percentages_str
                 )
+                # The analysis log is only collected when BB_DEBUG=1
+                if debug_log:
+                    with st.expander("🧠 AI Analysis Log"):
+                        st.markdown("\n\n".join(debug_log))
 
                 # --- Display the Final Output ---
                 if ai_says_output and formula_breakdown and routine_matches is not None:
-                    with output_container:
-                        st.markdown("---")
-                        st.subheader("🤖 AI Assistant Says:")
-                        for category, details in ai_says_output.items():
-                            # Don't show a score for the summary
-                            score_display = f"**Score {details['score']}/10**" if details['score'] else ""
-                            st.markdown(f"**{category}:** {score_display}")
-                            st.write(details['narrative'])
-
-                        # REPLACED: New breakdown section using expanders and showing concerns
-                        st.subheader("🔬 Formula Effectiveness Breakdown:")
-                        # Sort categories by score to show the most relevant first
-                        sorted_categories = sorted(
-                            [item for item in ai_says_output.items() if item[0] != "Summary"],
-                            key=lambda item: item[1]['score'],
-                            reverse=True
-                        )
-
-                        for category_name, details in sorted_categories:
-                            # Only show for relevant categories with a score above 3.0
-                            if details['score'] > 3.0 and category_name in formula_breakdown:
-                                with st.expander(f"**{category_name} (Score: {details['score']}/10)**"):
-                                    for list_name, ingredients in formula_breakdown[category_name].items():
-                                        if ingredients: # Only show if the list is not empty
-                                            st.markdown(f"**{list_name}:**")
-                                            st.write(" • " + " • ".join(ingredients))
-
-                        # Display Potential Concerns if any were found
-                        if potential_concerns:
-                            st.subheader("⚠️ Potential Concerns & Usage Notes:")
-                            for concern in potential_concerns:
-                                st.warning(concern)
-
-
-                        st.subheader("📋 Routine Placements (Internal Use):")
-                        if routine_matches:
-                            st.code("\n".join(routine_matches), language=None)
-                        else:
-                            st.info("No perfect routine placements were found based on the analysis.")
+                    st.session_state["last_display"] = build_display(ai_says_output, formula_breakdown, routine_matches, potential_concerns)
 
             except Exception:
                 st.error("An unexpected error occurred in the main application.")
                 st.code(traceback.format_exc())
+
+# The last results are painted on every rerun, so editing an input keeps them on screen without re-analyzing.
+if "last_display" in st.session_state:
+    with output_container:
+        render_results(st.session_state["last_display"])
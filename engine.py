@@ -1,34 +1,130 @@
 import streamlit as st
+import codecs
+import functools
+import hashlib
 import json
+import math
+import os
+import pathlib
+import pickle
 import traceback
 import re
-from thefuzz import process
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from thefuzz import utils as fuzz_utils
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib parser is used as a fallback
+    orjson = None
+
+# Set BB_DEBUG=1 to render the step-by-step analysis log and its per-ingredient dumps.
+DEBUG = os.getenv("BB_DEBUG") == "1"
+
+# --- INCI PARSING ---
+# Separators between INCI entries, consuming the surrounding whitespace in the same pass.
+INCI_SEPARATOR_RE = re.compile(r'\s*[,;]\s*')
+INCI_TRAILING_MARK_RE = re.compile(r'[\.\*]$')
+
+# --- PRODUCT TYPE KEYWORDS ---
+# Product-name keywords mapped to product profiles, in priority order: when a name holds several keywords, the earlier
+# entry wins, which also keeps specific keywords ("eye cream") ahead of the generic ones they contain ("cream").
+PRODUCT_KEYWORD_MAP = {
+    "oil cleanser": "Oil-based Cleanser", "cleansing oil": "Oil-based Cleanser", "cleansing balm": "Oil-based Cleanser",
+    "cream cleanser": "Hydrating Cream Cleanser", "milk cleanser": "Hydrating Cream Cleanser", "foaming cleanser": "Gentle Foaming Cleanser", "purifying cleanser": "Gentle Foaming Cleanser",
+    "rich cream": "Barrier Repair Moisturizer", "barrier cream": "Barrier Repair Moisturizer", "night cream": "Anti-aging Moisturizer",
+    "lotion": "Lightweight Moisturizer", "gel cream": "Lightweight Moisturizer", "sunscreen": "SPF 30+", "spf": "SPF 30+",
+    "serum": "Hydrating Serum", "essence": "Hydrating Essence", "toner": "Hydrating Toner", "clay mask": "Clay Mask", "mask": "Hydrating Mask or Oil",
+    "face oil": "Face Oil", "eye cream": "Eye Cream", "lip balm": "Lip Balm", "mist": "Hydrating Mist",
+    "cleanser": "Gentle Foaming Cleanser", "cream": "Barrier Repair Moisturizer", "moisturizer": "Lightweight Moisturizer"
+}
+
+# Role-name keywords a product profile may be placed as, used when identifying product roles.
+VALID_ROLE_KEYWORDS = {
+    "Toner": ("toner",), "Essence": ("essence",), "Serum": ("serum",), "Moisturizer (Lightweight)": ("moisturizer",), "Moisturizer (Rich)": ("moisturizer",),
+    "Cleanser (Foaming)": ("cleanser",), "Cleanser (Cream)": ("cleanser",), "Cleanser (Oil-based)": ("cleanser",), "Mask (Wash-off Gel/Cream)": ("mask", "oil"),
+    "Mask (Clay)": ("mask",), "Face Oil": ("oil", "mask"), "Eye Cream": ("eye cream",), "Sunscreen": ("spf", "sunscreen"), "Lip Balm": ("lip balm",), "Mist": ("mist",)
+}
+
+# --- HEURISTIC RULES ---
+# Name fragments used to infer functions for ingredients that are not in the database.
+HEURISTIC_KEYWORD_FUNCTIONS = {
+    "extract": ("Antioxidant", "Soothing"),
+    "ferment": ("Soothing", "Hydration"),
+    "water": ("Soothing", "Hydration"),
+}
+HEURISTIC_KEYWORD_RE = re.compile("|".join(re.escape(keyword) for keyword in HEURISTIC_KEYWORD_FUNCTIONS))
+
+# Functions that classify an ingredient as "Positive Impact".
+POSITIVE_FUNCTIONS = frozenset({"Hydration", "Soothing", "Antioxidant", "Brightening", "Anti-aging", "Exfoliation (mild)", "Barrier Support", "Sebum Regulation", "UV Protection", "Emollient", "Humectant"})
+
+# --- FUZZY MATCHING ---
+# thefuzz's extractOne ran full_process(force_ascii=True) on both the query and the choices. RapidFuzz gets the
+# same processor, so accented spellings still fold to ASCII and the score cutoffs keep their meaning.
+FUZZY_PROCESSOR = functools.partial(fuzz_utils.full_process, force_ascii=True)
 
 # --- DATA LOADING ---
-@st.cache_data
-def load_all_data():
+DATA_FILES = {
+    "skin_types": "data/skin_types.json",
+    "routines": "data/routines.json",
+    "product_profiles": "data/product_profiles.json",
+    "product_functions": "data/product_functions.json",
+    "one_percent_markers": "data/one_percent_markers.json",
+    "ingredients": "data/ingredients.json",
+    "narrative_templates": "data/narrative_templates.json",
+    "scoring_config": "data/scoring_config.json",
+    "prohibited_ingredients": "data/prohibited_ingredients.json",
+    "category_scoring_rules": "data/category_scoring_rules.json",
+    "usage_ranges": "data/ingredient_usage_ranges.json"
+}
+# Optional pickled snapshot of build_all_data(), generated by scripts/build_cache.py.
+ALL_DATA_CACHE_PATH = "data/all_data.pkl"
+# The derived indexes also depend on code in this module (POSITIVE_FUNCTIONS, VALID_ROLE_KEYWORDS, category_mask,
+# usage_midpoint, build_all_data itself), so any edit to this file invalidates older snapshots.
+ENGINE_SOURCE_HASH = hashlib.sha256(pathlib.Path(__file__).read_bytes()).hexdigest()
+
+def usage_midpoint(perc_range):
+    # Below the 1% line an ingredient is estimated at the middle of its usage range, capped at 1%.
+    return min(sum(perc_range) / 2, 1.0)
+
+# Used for sub-1% ingredients without a usage range of their own.
+DEFAULT_USAGE_MIDPOINT = usage_midpoint([0.05, 0.5])
+
+def category_mask(functions, category_generic_functions, category_bits):
+    """
+    Returns one bit for every scoring category whose generic functions overlap the given
+    functions.
+    """
+    mask = 0
+    for category, generic_functions in category_generic_functions.items():
+        if not generic_functions.isdisjoint(functions):
+            mask |= category_bits[category]
+    return mask
+
+def read_json_file(path):
+    """
+    Reads a JSON file as raw bytes, dropping a UTF-8 BOM if present, and parses it with
+    orjson when available.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+@st.cache_data(show_spinner=False, ttl=None)
+def load_data_files():
     """
     Loads all necessary JSON data files from the 'data' folder.
     """
     data = {}
-    files_to_load = {
-        "skin_types": "data/skin_types.json",
-        "routines": "data/routines.json",
-        "product_profiles": "data/product_profiles.json",
-        "product_functions": "data/product_functions.json",
-        "one_percent_markers": "data/one_percent_markers.json",
-        "ingredients": "data/ingredients.json",
-        "narrative_templates": "data/narrative_templates.json",
-        "scoring_config": "data/scoring_config.json",
-        "prohibited_ingredients": "data/prohibited_ingredients.json",
-        "category_scoring_rules": "data/category_scoring_rules.json",
-        "usage_ranges": "data/ingredient_usage_ranges.json"
-    }
-    
-    for name, path in files_to_load.items():
+    # Files are read and parsed concurrently; errors surface (and are reported) below, in file order.
+    with ThreadPoolExecutor(max_workers=len(DATA_FILES)) as executor:
+        pending = {name: executor.submit(read_json_file, path) for name, path in DATA_FILES.items()}
+    for name, path in DATA_FILES.items():
         try:
-            with open(path, 'r', encoding='utf-8-sig') as f:
-                data[name] = json.load(f)
+            data[name] = pending[name].result()
         except FileNotFoundError:
             if name == "usage_ranges":
                 st.warning(f"Optional data file not found at '{path}'. Estimation will be less accurate.")
@@ -37,17 +133,144 @@ def load_all_data():
                 raise FileNotFoundError(f"Fatal Error: A required data file was not found at '{path}'.")
         except json.JSONDecodeError as e:
             raise ValueError(f"Fatal Error: Error decoding JSON from file '{path}': {e}.")
-            
+
+    return data
+
+def build_all_data():
+    """
+    Returns the parsed data files together with the derived lookup indexes used by the
+    analysis.
+    """
+    data = load_data_files()
+    # Lowercased once so the safety check is a hash lookup per ingredient before any matching runs.
+    data["prohibited_ingredient_set"] = frozenset(ing.lower() for ing in data["prohibited_ingredients"].get("ingredients", []))
+    # INCI names are lowercased during parsing, so the 1% line markers must be too.
+    data["one_percent_marker_set"] = frozenset(marker.lower() for marker in data["one_percent_markers"].get("markers", []))
+    # Per skin type: the (function, bonus) pairs it rewards and their total, which only depend on static data.
+    priority_scores = data["scoring_config"]["priority_fulfillment_scores"]
+    skin_type_bonuses = {}
+    for type_id, skin_type in data["skin_types"].items():
+        good_for_list = skin_type.get("good_for_functions", [])
+        bonus_pairs = tuple(
+            (priority_func["function"], priority_scores.get(f"{priority_func['priority']}_priority_bonus", 0))
+            for priority_func in (good_for_list if isinstance(good_for_list, list) else [])
+            if isinstance(priority_func, dict) and priority_func.get("function") and priority_func.get("priority")
+        )
+        skin_type_bonuses[type_id] = (bonus_pairs, sum(bonus for _, bonus in bonus_pairs))
+    data["skin_type_bonuses"] = skin_type_bonuses
+    data["skin_type_bad_ingredients"] = {type_id: frozenset(bad_ing.lower() for bad_ing in skin_type.get('bad_for_ingredients', [])) for type_id, skin_type in data["skin_types"].items()}
+    # Required functions per product role, as sets so role matching is a subset test.
+    data["product_role_requirements"] = {role: frozenset(rules.get('must_have_functions', [])) for role, rules in data["product_functions"].items() if isinstance(rules, dict)}
+    # The roles each product profile may be placed as, resolved from the role keywords once rather than on every analysis.
+    data["candidate_roles_by_profile"] = {
+        profile_key: tuple((role, must_have) for role, must_have in data["product_role_requirements"].items() if any(keyword in role.lower() for keyword in keywords))
+        for profile_key, keywords in VALID_ROLE_KEYWORDS.items()
+    }
+    # Routine steps keyed by the product function they call for, tagged with their position in the file so merged lists keep
+    # routine order, and with the skin type the routine belongs to ("Type 1-3-morning" -> "Type 1").
+    routine_steps_by_function = {}
+    routine_steps = ((routine_key, step) for routine_key, routine_details in data["routines"].items() for step in routine_details.get("steps", []))
+    for position, (routine_key, step) in enumerate(routine_steps):
+        routine_steps_by_function.setdefault(step["product_function"], []).append((position, routine_key.split('-')[0], routine_key, step["step_number"]))
+    data["routine_steps_by_function"] = {func: tuple(steps) for func, steps in routine_steps_by_function.items()}
+    # Usage-range midpoints per ingredient and product type, read for every ingredient below the 1% line.
+    data["usage_range_midpoints"] = {
+        name: {key: usage_midpoint(perc_range) for key, perc_range in ranges.items()}
+        for name, ranges in data.get("usage_ranges", {}).items() if isinstance(ranges, dict)
+    }
+    # Per category: the generic functions it rewards, and every rule ingredient name lowercased and de-duplicated across categories.
+    scoring_categories = data["category_scoring_rules"].get("categories", {})
+    data["category_generic_functions"] = {category: frozenset(rules.get("generic_functions", [])) for category, rules in scoring_categories.items()}
+    data["category_bits"] = {category: 1 << i for i, category in enumerate(scoring_categories)}
+    rule_names = []
+    for rules in scoring_categories.values():
+        rule_names.extend(star["name"].lower() for star in rules.get("star_ingredients", []))
+        rule_names.extend(name.lower() for name in rules.get("supporting_ingredients", {}))
+    data["scoring_rule_names"] = tuple(dict.fromkeys(rule_names))
     if "ingredients" in data:
-        data["ingredient_names_for_matching"] = [item['inci_name'].lower() for item in data["ingredients"]]
+        data["ingredient_names_for_matching"] = tuple(item['inci_name'].lower() for item in data["ingredients"])
+        # Exact-match indexes so the analysis hot path only falls back to fuzzy matching on true misses.
+        data["ingredients_by_name"] = dict(zip(data["ingredient_names_for_matching"], data["ingredients"]))
+        data["ingredient_names_set"] = frozenset(data["ingredients_by_name"])
+        # Restrictions come from the first record of a name, which is where duplicated entries keep them.
+        restrictions_by_name = {}
+        for name, item in zip(data["ingredient_names_for_matching"], data["ingredients"]):
+            restrictions_by_name.setdefault(name, item.get("restrictions"))
+        data["restrictions_by_name"] = restrictions_by_name
+        # Flattened, de-duplicated functions across all behaviors of each ingredient.
+        functions_by_name = {}
+        for name, item in data["ingredients_by_name"].items():
+            functions = []
+            behaviors = item.get('behaviors')
+            for behavior in behaviors if isinstance(behaviors, list) else []:
+                if isinstance(behavior, dict) and behavior.get('functions'):
+                    functions.extend(behavior['functions'])
+            functions_by_name[name] = tuple(dict.fromkeys(functions))
+        data["functions_by_name"] = functions_by_name
+        # Each ingredient's function set, positive-impact flag and scoring-category mask, so a database hit is classified by one lookup.
+        data["function_profile_by_name"] = {
+            name: (frozenset(functions), not POSITIVE_FUNCTIONS.isdisjoint(functions), category_mask(functions, data["category_generic_functions"], data["category_bits"]))
+            for name, functions in functions_by_name.items()
+        }
 
     return data
 
-try:
-    ALL_DATA = load_all_data()
-except (FileNotFoundError, ValueError) as e:
-    st.error(str(e))
-    st.stop()
+def data_files_signature():
+    """
+    Returns a hash of the engine source together with the size and modification time of
+    every data file, so a stale snapshot can be detected without parsing any JSON.
+    """
+    signature = [ENGINE_SOURCE_HASH]
+    for path in DATA_FILES.values():
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+def save_all_data_cache(data, signature):
+    """
+    Writes the snapshot atomically, so a concurrent reader never sees a partial file.
+    """
+    tmp_path = f"{ALL_DATA_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((signature, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, ALL_DATA_CACHE_PATH)
+
+@st.cache_resource(show_spinner=False)
+def load_all_data():
+    """
+    Loads the pickled data snapshot when it matches the current data files, and otherwise
+    builds everything from the JSON files and refreshes the snapshot. Cached as a shared
+    resource so this happens once per process; callers must treat the result as read-only.
+    """
+    signature = data_files_signature()
+    try:
+        with open(ALL_DATA_CACHE_PATH, 'rb') as f:
+            cached_signature, data = pickle.load(f)
+        if cached_signature == signature:
+            return data
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+        pass
+
+    data = build_all_data()
+    try:
+        save_all_data_cache(data, signature)
+    except OSError:
+        pass  # A read-only checkout still works; it just rebuilds on every cold start.
+    return data
+
+def get_all_data():
+    """
+    Returns the shared data on first use rather than at import, so the page renders before
+    any data is read. A missing or broken data file stops the run with an error.
+    """
+    try:
+        return load_all_data()
+    except (FileNotFoundError, ValueError) as e:
+        st.error(str(e))
+        st.stop()
 
 # --- HELPER FUNCTION ---
 def parse_known_percentages(known_percentages_str):
@@ -61,247 +284,277 @@ def parse_known_percentages(known_percentages_str):
             except ValueError: continue
     return known_percentages
 
+def parse_inci_list(inci_list_str):
+    # The whole list is lowercased in one pass; every later stage relies on that and matches names as-is.
+    raw_list = INCI_SEPARATOR_RE.split(inci_list_str.strip().lower())
+    # Repeated entries are collapsed to their first (highest-concentration) position, so
+    # every later stage can address ingredients by position as well as by name.
+    return tuple(dict.fromkeys(INCI_TRAILING_MARK_RE.sub('', item.partition('/')[0].strip()) for item in raw_list if item))
+
 # --- MAIN ANALYSIS ORCHESTRATOR ---
 def run_full_analysis(product_name, inci_list_str, known_percentages_str):
+    """
+    Parses the INCI list before the cached analysis, so lists that differ only in case,
+    spacing or separators share one cache entry. Returns the four analysis results, or
+    four Nones if the analysis was halted, followed by the analysis log lines for the
+    caller to render.
+    """
+    return run_parsed_analysis(product_name, parse_inci_list(inci_list_str), known_percentages_str)
+
+# Results are memoized per parsed input. The log is returned rather than written, so a cache hit
+# returns it as plain data; Streamlit only replays the rare error elements.
+@st.cache_data(ttl="1h", max_entries=256, show_spinner=False)
+def run_parsed_analysis(product_name, inci_list, known_percentages_str):
+    all_data = get_all_data()
+    # Log lines are collected by every stage and handed back with the results.
+    debug_log = []
     try:
-        st.write("---"); st.write("### 🧠 AI Analysis Log"); st.write("_[This log shows the AI's step-by-step reasoning]_")
-        
-        raw_list = [item.strip().lower() for item in inci_list_str.split(',') if item.strip()]
-        inci_list = [re.sub(r'[\.\*]$', '', item.split('/')[0].strip()) for item in raw_list]
-        st.write(f"**[DEBUG] Step 0: Pre-processing complete.** Found {len(inci_list)} cleaned ingredients.")
+        if DEBUG:
+            debug_log.append("_[This log shows the AI's step-by-step reasoning]_")
+            debug_log.append(f"**[DEBUG] Step 0: Pre-processing complete.** Found {len(inci_list)} cleaned ingredients.")
 
-        prohibited_found = check_for_prohibited(inci_list, ALL_DATA["prohibited_ingredients"])
+        prohibited_found = check_for_prohibited(inci_list, all_data["prohibited_ingredient_set"])
         if prohibited_found:
             st.error(f"⚠️ **SAFETY ALERT:** This product contains a substance prohibited in cosmetic products in the EU: **{prohibited_found.title()}**. Analysis halted.")
-            return None, None, None, None
+            return None, None, None, None, debug_log
 
         known_percentages = parse_known_percentages(known_percentages_str)
-        st.write(f"**[DEBUG] Known Percentages Parsed:** `{known_percentages}`")
+        if DEBUG: debug_log.append(f"**[DEBUG] Known Percentages Parsed:** `{known_percentages}`")
         
-        profile, profile_key = get_product_profile(product_name, ALL_DATA["product_profiles"])
+        profile, profile_key = get_product_profile(product_name, all_data["product_profiles"], debug_log)
         if not profile:
             st.error("Fatal Error: Could not retrieve a valid product profile. Analysis halted.")
-            return None, None, None, None
+            return None, None, None, None, debug_log
         
-        ingredients_with_percentages = estimate_percentages(inci_list, profile, ALL_DATA, known_percentages, profile_key)
+        ingredients_with_percentages = estimate_percentages(inci_list, profile, all_data, known_percentages, profile_key, debug_log)
         
-        analyzed_ingredients = analyze_ingredient_functions(ingredients_with_percentages, ALL_DATA)
-        product_roles = identify_product_roles(analyzed_ingredients, ALL_DATA["product_functions"], profile_key)
+        analyzed_ingredients = analyze_ingredient_functions(ingredients_with_percentages, all_data, debug_log)
+        # Every function the formula provides, shared by role identification and routine matching.
+        product_functions = frozenset().union(*(ing['functions'] for ing in analyzed_ingredients))
+        product_roles = identify_product_roles(product_functions, all_data["candidate_roles_by_profile"].get(profile_key, ()), profile_key, debug_log)
         
-        ai_says_output, formula_breakdown, potential_concerns = generate_analysis_output(analyzed_ingredients, ALL_DATA["narrative_templates"], ALL_DATA["category_scoring_rules"], ALL_DATA["ingredients"])
+        ai_says_output, formula_breakdown, potential_concerns = generate_analysis_output(analyzed_ingredients, all_data["narrative_templates"], all_data["category_scoring_rules"], all_data, debug_log)
         
-        routine_matches = find_all_routine_matches(product_roles, analyzed_ingredients, ALL_DATA)
+        routine_matches = find_all_routine_matches(product_roles, analyzed_ingredients, product_functions, all_data, debug_log)
 
-        return ai_says_output, formula_breakdown, routine_matches, potential_concerns
+        return ai_says_output, formula_breakdown, routine_matches, potential_concerns, debug_log
 
     except ValueError as e:
         st.error(f"Input Error: {e}")
-        return None, None, None, None
+        return None, None, None, None, debug_log
     except Exception:
         st.error("An unexpected error occurred during the analysis process.")
         st.code(traceback.format_exc())
-        return None, None, None, None
+        return None, None, None, None, debug_log
 
-def check_for_prohibited(inci_list, prohibited_data):
-    prohibited_set = set(ing.lower() for ing in prohibited_data.get("ingredients", []))
-    for ingredient in inci_list:
-        if ingredient in prohibited_set: return ingredient
-    return None
+def check_for_prohibited(inci_list, prohibited_set):
+    # The common clean case is one C-level disjointness test; only a hit walks the list for its first match.
+    if prohibited_set.isdisjoint(inci_list): return None
+    return next(ingredient for ingredient in inci_list if ingredient in prohibited_set)
 
-def get_product_profile(product_name, profiles_data):
+def get_product_profile(product_name, profiles_data, debug_log):
     name_lower = product_name.lower()
-    keyword_map = {
-        "oil cleanser": "Oil-based Cleanser", "cleansing oil": "Oil-based Cleanser", "cleansing balm": "Oil-based Cleanser",
-        "cream cleanser": "Hydrating Cream Cleanser", "milk cleanser": "Hydrating Cream Cleanser", "foaming cleanser": "Gentle Foaming Cleanser", "purifying cleanser": "Gentle Foaming Cleanser",
-        "rich cream": "Barrier Repair Moisturizer", "barrier cream": "Barrier Repair Moisturizer", "night cream": "Anti-aging Moisturizer",
-        "lotion": "Lightweight Moisturizer", "gel cream": "Lightweight Moisturizer", "sunscreen": "SPF 30+", "spf": "SPF 30+",
-        "serum": "Hydrating Serum", "essence": "Hydrating Essence", "toner": "Hydrating Toner", "clay mask": "Clay Mask", "mask": "Hydrating Mask or Oil",
-        "face oil": "Face Oil", "eye cream": "Eye Cream", "lip balm": "Lip Balm", "mist": "Hydrating Mist",
-        "cleanser": "Gentle Foaming Cleanser", "cream": "Barrier Repair Moisturizer", "moisturizer": "Lightweight Moisturizer"
-    }
-    for keyword, profile_key in keyword_map.items():
+    for keyword, profile_key in PRODUCT_KEYWORD_MAP.items():
         if keyword in name_lower:
             profile = profiles_data.get(profile_key)
             if profile:
-                st.write(f"**[DEBUG] Stage 1: Product Profile Identified.** Keyword: `{keyword}`. Profile: **{profile_key}**")
+                if DEBUG: debug_log.append(f"**[DEBUG] Stage 1: Product Profile Identified.** Keyword: `{keyword}`. Profile: **{profile_key}**")
                 return profile, profile_key
     st.warning("Could not automatically determine product type. Using 'Hydrating Serum' as a default.")
     return profiles_data.get("Hydrating Serum"), "Hydrating Serum"
 
-# --- FINAL ROBUST VERSION: Iterative Search with Best-Result Tracking ---
-def estimate_percentages(inci_list, profile, all_data, known_percentages, profile_key):
+# --- FINAL ROBUST VERSION: Closed-Form Solvent Solve ---
+def estimate_percentages(inci_list, profile, all_data, known_percentages, profile_key, debug_log):
     """
-    Estimates ingredient percentages using a robust iterative search model. This version
-    tracks the result that is closest to a 100% sum across all iterations to ensure
-    the best possible solution is returned, preventing >100% sums.
+    Estimates ingredient percentages by interpolating linearly between known anchors. The
+    solvent value at the top of the list is solved directly so the formula sums to 100%,
+    within the profile's solvent range, preventing >100% sums.
     """
-    st.write("✅ **Running the definitive ITERATIVE SEARCH logic (Best Result Tracking).**")
+    if DEBUG: debug_log.append("✅ **Running the definitive CLOSED-FORM SOLVE logic (Solvent Range Clamped).**")
     
     # --- Step 1: Pre-computation of constant values (anchors and below-1% zone) ---
-    known_ingredients_map = {}
+    # Ingredients are held as parallel arrays indexed by INCI position: the names list,
+    # a float64 array of percentages and a mask of positions anchored by a known value.
+    num_ingredients = len(inci_list)
+    base_percentages = np.zeros(num_ingredients, dtype=np.float64)
+    anchored = np.zeros(num_ingredients, dtype=np.bool_)
+    anchor_indices = []
     last_known_perc = 101.0
-    for i, name in enumerate(inci_list):
-        for known_name, known_perc in known_percentages.items():
-            if process.extractOne(known_name, [name])[1] > 95:
+    # Every known name is scored against every INCI entry in one batched call; each entry takes
+    # the first known name (in input order) that matches it.
+    known_items = list(known_percentages.items())
+    known_scores = fuzzy_score_matrix([known_name for known_name, _ in known_items], inci_list).T if known_items and inci_list else ()
+    for i, scores in enumerate(known_scores):
+        for (known_name, known_perc), score in zip(known_items, scores):
+            if score > 95:
                 if known_perc > last_known_perc:
                     raise ValueError("Your known percentages violate the descending order rule.")
-                known_ingredients_map[name] = {'perc': known_perc, 'index': i}
+                base_percentages[i] = known_perc
+                anchored[i] = True
+                anchor_indices.append(i)
                 last_known_perc = known_perc
                 break
 
-    one_percent_markers = all_data.get("one_percent_markers", {}).get("markers", [])
-    usage_ranges = all_data.get("usage_ranges", {})
-    one_percent_line_index = next((i for i, ing in enumerate(inci_list) if ing in one_percent_markers and ing not in known_ingredients_map), len(inci_list))
-
-    below_1_percs = {}
-    for i in range(one_percent_line_index, len(inci_list)):
-        ing = inci_list[i]
-        if ing not in known_ingredients_map:
-            ing_ranges = usage_ranges.get(ing.lower(), {})
-            perc_range = ing_ranges.get(profile_key, ing_ranges.get("default", [0.05, 0.5]))
-            below_1_percs[ing] = min(sum(perc_range) / 2, 1.0)
+    one_percent_markers = all_data["one_percent_marker_set"]
+    usage_range_midpoints = all_data["usage_range_midpoints"]
+    one_percent_line_index = next((i for i, ing in enumerate(inci_list) if ing in one_percent_markers and not anchored[i]), num_ingredients)
+
+    # Everything below the 1% line that has no known value takes its usage-range midpoint, filled in one masked copy.
+    below_line = slice(one_percent_line_index, num_ingredients)
+    midpoints = [usage_range_midpoints.get(name, {}) for name in inci_list[below_line]]
+    below_line_percentages = np.array([m.get(profile_key, m.get("default", DEFAULT_USAGE_MIDPOINT)) for m in midpoints], dtype=np.float64)
+    np.copyto(base_percentages[below_line], below_line_percentages, where=~anchored[below_line])
     
-    # --- Step 2: The Iterative Search with Best-Result Tracking ---
+    # --- Step 2: Solve for the solvent start value ---
     low_bound, high_bound = profile.get("base_solvent_range", [40, 98])
     
-    # Variables to store the best result found during the search
-    best_result = {}
-    smallest_error = float('inf')
-
-    # Increased iterations for better convergence on complex lists
-    for _ in range(15):
-        guess_start_perc = (low_bound + high_bound) / 2
-        
-        temp_percentages = {name: 0.0 for name in inci_list}
-        temp_percentages.update({k: v['perc'] for k, v in known_ingredients_map.items()})
-        temp_percentages.update(below_1_percs)
-        
-        # Run the trusted interpolation logic with the current guess
-        anchors_above_1 = [a for a in known_ingredients_map.values() if a['index'] < one_percent_line_index]
-        start_anchor = {'index': -1, 'perc': guess_start_perc}
-        end_anchor = {'index': one_percent_line_index, 'perc': 1.0}
-        all_anchors = sorted(list({v['index']: v for v in [start_anchor] + anchors_above_1 + [end_anchor]}.values()), key=lambda x: x['index'])
-
-        for i in range(len(all_anchors) - 1):
-            s_anchor, e_anchor = all_anchors[i], all_anchors[i+1]
-            num_ingredients_in_segment = e_anchor['index'] - s_anchor['index'] - 1
-            if num_ingredients_in_segment > 0:
-                step_size = (s_anchor['perc'] - e_anchor['perc']) / (num_ingredients_in_segment + 1)
-                for j in range(num_ingredients_in_segment):
-                    ing_index = s_anchor['index'] + 1 + j
-                    ing_name = inci_list[ing_index]
-                    if ing_name not in known_ingredients_map:
-                        temp_percentages[ing_name] = s_anchor['perc'] - (step_size * (j + 1))
-        
-        current_total = sum(temp_percentages.values())
-        error = abs(100.0 - current_total)
-        
-        # ** THE FIX: Check if this iteration produced a better result (closer to 100) **
-        if error < smallest_error:
-            smallest_error = error
-            best_result = temp_percentages
-        
-        # Refine the search space for the next iteration
-        if current_total > 100.0:
-            high_bound = guess_start_perc
-        else:
-            low_bound = guess_start_perc
-            
-    final_percentages = best_result
+    # Every known value above the 1% line is itself an anchor, so each segment between anchors
+    # is a contiguous run of positions whose values decay linearly from one anchor to the next.
+    all_anchors = [(-1, None)] + [(i, base_percentages[i]) for i in anchor_indices if i < one_percent_line_index] + [(one_percent_line_index, 1.0)]
+    # Segments are filled last to first, so the first (solvent) segment sees every other value.
+    percentages = base_percentages.copy()
+    for (s_index, s_perc), (e_index, e_perc) in reversed(list(zip(all_anchors, all_anchors[1:]))):
+        num_ingredients_in_segment = e_index - s_index - 1
+        if num_ingredients_in_segment <= 0: continue
+        positions = slice(s_index + 1, e_index)
+        # Share of the start anchor's value in each position: 1 at the start anchor, 0 at the end anchor.
+        start_weights = 1.0 - np.arange(1, num_ingredients_in_segment + 1, dtype=np.float64) / (num_ingredients_in_segment + 1)
+        if s_perc is None:
+            # The first segment starts at the unknown solvent value s, so the formula total is affine
+            # in s; solve it for a 100% total directly and clamp to the profile's solvent range.
+            # Over k positions both weight sums are arithmetic series equal to k/2.
+            half_segment = num_ingredients_in_segment / 2
+            fixed_total = float(percentages.sum()) + e_perc * half_segment
+            s_perc = min(max((100.0 - fixed_total) / half_segment, low_bound), high_bound)
+        percentages[positions] = s_perc * start_weights + e_perc * (1.0 - start_weights)
 
     # Final sanity check for negative values caused by edge cases
-    for name in final_percentages:
-        if final_percentages.get(name, 0) < 0:
-            final_percentages[name] = 0.0
+    final_percentages = np.maximum(percentages, 0.0).tolist()
 
-    st.write(f"**[DEBUG] Stage 2: Full Estimated Formula.**")
-    st.text("\n".join([f"- {name}: {perc:.4f}%" for name, perc in final_percentages.items()]))
+    if DEBUG:
+        debug_log.append(f"**[DEBUG] Stage 2: Full Estimated Formula.**")
+        debug_log.append("```\n" + "\n".join([f"- {name}: {perc:.4f}%" for name, perc in zip(inci_list, final_percentages)]) + "\n```")
     
-    return [{"name": name, "estimated_percentage": perc} for name, perc in final_percentages.items()]
+    return [{"name": name, "estimated_percentage": perc} for name, perc in zip(inci_list, final_percentages)]
     
-def analyze_ingredient_functions(ingredients_with_percentages, all_data):
+def match_ingredient_names(names, all_data, score_cutoff=85):
+    """
+    Resolves each name to its database INCI name. Exact hits are a set lookup; all
+    remaining names are fuzzy-matched in a single batched RapidFuzz call.
+    """
     db_names = all_data["ingredient_names_for_matching"]
-    ingredients_dict = {item['inci_name'].lower(): item for item in all_data["ingredients"]}
-    annotated_list = []
-    
-    for item in ingredients_with_percentages:
-        ingredient_name_lower = item['name'].lower()
-        if ingredient_name_lower == 'aqua': ingredient_name_lower = 'water'
-        functions, source = [], "Heuristic"
-        best_match = None
-
-        if ingredient_name_lower in db_names: best_match = (ingredient_name_lower, 100)
-        else: best_match = process.extractOne(ingredient_name_lower, db_names, score_cutoff=85)
-
-        if best_match:
-            matched_name = best_match[0]
-            data = ingredients_dict.get(matched_name)
-            if data and isinstance(data.get('behaviors'), list):
-                for behavior in data['behaviors']:
-                    if isinstance(behavior, dict) and behavior.get('functions'):
-                        functions.extend(behavior.get('functions', []))
-                if functions: source = f"Database (Match: {matched_name})"
-
-        if source == "Heuristic":
-            if "extract" in ingredient_name_lower: functions.extend(["Antioxidant", "Soothing"])
-            if "ferment" in ingredient_name_lower: functions.extend(["Soothing", "Hydration"])
-            if "water" in ingredient_name_lower and "aqua" not in ingredient_name_lower: functions.extend(["Soothing", "Hydration"])
-
-        positive_functions = ["Hydration", "Soothing", "Antioxidant", "Brightening", "Anti-aging", "Exfoliation (mild)", "Barrier Support", "Sebum Regulation", "UV Protection", "Emollient", "Humectant"]
-        unique_functions = list(set(functions))
-        classification = "Positive Impact" if any(pf in unique_functions for pf in positive_functions) else "Neutral/Functional"
-        item.update({'functions': unique_functions, 'classification': classification, 'source': source})
-        annotated_list.append(item)
-
-    st.write(f"**[DEBUG] Stage 3: Ingredient Functions Analyzed.**")
-    st.text("\n".join([f"- {ing['name']} ({ing['classification']}) (Source: {ing.get('source', 'N/A')}): {ing.get('functions', [])}" for ing in annotated_list]))
+    db_names_set = all_data["ingredient_names_set"]
+    matches = {name: name for name in names if name in db_names_set}
+    misses = list({name: None for name in names if name not in matches})
+    if misses and db_names:
+        scores = rf_process.cdist(misses, db_names, scorer=rf_fuzz.WRatio, processor=FUZZY_PROCESSOR, score_cutoff=score_cutoff, workers=-1)
+        best_idx = scores.argmax(axis=1)
+        for row, name in enumerate(misses):
+            best_score = scores[row, best_idx[row]]
+            matches[name] = db_names[best_idx[row]] if best_score >= score_cutoff else None
+    return matches
+
+def fuzzy_score_matrix(queries, choices):
+    """
+    Scores every query against every choice in one batched RapidFuzz call. Scores are
+    rounded the same way thefuzz's extractOne rounds them, so existing thresholds keep
+    their meaning.
+    """
+    return rf_process.cdist(queries, choices, scorer=rf_fuzz.WRatio, processor=FUZZY_PROCESSOR, workers=-1).round()
+
+def analyze_ingredient_functions(ingredients_with_percentages, all_data, debug_log):
+    function_profile_by_name = all_data["function_profile_by_name"]
+
+    lookup_names = ['water' if item['name'] == 'aqua' else item['name'] for item in ingredients_with_percentages]
+    name_matches = match_ingredient_names(lookup_names, all_data)
+
+    # Repeated names (e.g. aqua/water synonyms) are resolved once and scattered back to every occurrence.
+    resolved_by_name = {}
+    for ingredient_name_lower in lookup_names:
+        if ingredient_name_lower in resolved_by_name: continue
+        matched_name = name_matches.get(ingredient_name_lower)
+        unique_functions, is_positive, generic_categories = function_profile_by_name.get(matched_name, (frozenset(), False, 0))
+
+        if unique_functions:
+            source = f"Database (Match: {matched_name})"
+        else:
+            source, functions = "Heuristic", set()
+            for keyword in set(HEURISTIC_KEYWORD_RE.findall(ingredient_name_lower)):
+                if keyword == "water" and "aqua" in ingredient_name_lower: continue
+                functions.update(HEURISTIC_KEYWORD_FUNCTIONS[keyword])
+            unique_functions = frozenset(functions)
+            is_positive = not POSITIVE_FUNCTIONS.isdisjoint(unique_functions)
+            generic_categories = category_mask(unique_functions, all_data["category_generic_functions"], all_data["category_bits"])
+
+        classification = "Positive Impact" if is_positive else "Neutral/Functional"
+        resolved_by_name[ingredient_name_lower] = (unique_functions, classification, source, generic_categories)
+
+    # Each record is built once with all of its keys, rather than grown in place with update(). Functions
+    # stay frozensets, shared by repeated names, so later stages can union and test them without copying.
+    annotated_list = [
+        {'name': item['name'], 'display_name': item['name'].title(), 'estimated_percentage': item['estimated_percentage'], 'functions': unique_functions, 'classification': classification, 'source': source, 'category_mask': generic_categories}
+        for item, (unique_functions, classification, source, generic_categories) in zip(ingredients_with_percentages, map(resolved_by_name.__getitem__, lookup_names))
+    ]
+
+    if DEBUG:
+        debug_log.append(f"**[DEBUG] Stage 3: Ingredient Functions Analyzed.**")
+        debug_log.append("```\n" + "\n".join(f"- {ing['name']} ({ing['classification']}) (Source: {ing.get('source', 'N/A')}): {sorted(ing.get('functions', []))}" for ing in annotated_list) + "\n```")
     return annotated_list
 
-def identify_product_roles(analyzed_ingredients, function_rules, profile_key):
-    product_functions = {func for ing in analyzed_ingredients for func in ing.get('functions', [])}
-    matched_roles = []
-    valid_roles_map = {
-        "Toner": ["toner"], "Essence": ["essence"], "Serum": ["serum"], "Moisturizer (Lightweight)": ["moisturizer"], "Moisturizer (Rich)": ["moisturizer"],
-        "Cleanser (Foaming)": ["cleanser"], "Cleanser (Cream)": ["cleanser"], "Cleanser (Oil-based)": ["cleanser"], "Mask (Wash-off Gel/Cream)": ["mask", "oil"],
-        "Mask (Clay)": ["mask"], "Face Oil": ["oil", "mask"], "Eye Cream": ["eye cream"], "Sunscreen": ["spf", "sunscreen"], "Lip Balm": ["lip balm"], "Mist": ["mist"]
-    }
-    valid_keywords = valid_roles_map.get(profile_key, [])
-    for role, rules in function_rules.items():
-        if isinstance(rules, dict) and any(keyword in role.lower() for keyword in valid_keywords):
-            if all(f in product_functions for f in rules.get('must_have_functions', [])): matched_roles.append(role)
+def identify_product_roles(product_functions, candidate_roles, profile_key, debug_log):
+    matched_roles = [role for role, must_have_functions in candidate_roles if must_have_functions <= product_functions]
     if not matched_roles and profile_key: matched_roles.append(profile_key)
-    st.write(f"**[DEBUG] Stage 4: Product Roles Identified.** Roles: **{', '.join(list(set(matched_roles)))}**")
-    return list(set(matched_roles))
+    # Candidate roles are distinct keys, so the matches need no de-duplication and keep their data-file order.
+    if DEBUG: debug_log.append(f"**[DEBUG] Stage 4: Product Roles Identified.** Roles: **{', '.join(matched_roles)}**")
+    return matched_roles
 
-def generate_analysis_output(analyzed_ingredients, templates, scoring_rules_data, ingredients_data):
+def generate_analysis_output(analyzed_ingredients, templates, scoring_rules_data, all_data, debug_log):
     ai_says_output, formula_breakdown, potential_concerns = {}, {}, []
-    ingredient_percentages = {ing['name'].lower(): ing['estimated_percentage'] for ing in analyzed_ingredients}
+    ingredient_percentages = {ing['name']: ing['estimated_percentage'] for ing in analyzed_ingredients}
+    ingredient_names = list(ingredient_percentages)
     scoring_rules = scoring_rules_data.get("categories", {})
+
+    # Score every rule ingredient against every product ingredient once, instead of one fuzzy call per pair per category.
+    rule_names = all_data["scoring_rule_names"]
+    rule_rows = {name: row for row, name in enumerate(rule_names)}
+    name_scores = fuzzy_score_matrix(rule_names, ingredient_names) if rule_names and ingredient_names else None
+
+    # One pass over the ingredients collects both each category's generic-function providers (from their
+    # precomputed category bits) and the usage restrictions to flag as concerns.
+    category_bits = all_data["category_bits"]
+    restrictions_by_name = all_data["restrictions_by_name"]
+    # extractOne's rounded score had to exceed 90; with half-to-even rounding that is a raw score strictly above 90.5.
+    concern_matches = match_ingredient_names(ingredient_names, all_data, score_cutoff=math.nextafter(90.5, 100))
+    generic_candidates = {category_name: [] for category_name in scoring_rules}
+    for ingredient in analyzed_ingredients:
+        for category_name, candidates in generic_candidates.items():
+            if ingredient['category_mask'] & category_bits[category_name]: candidates.append((ingredient['name'], ingredient['display_name']))
+        restrictions = restrictions_by_name.get(concern_matches.get(ingredient['name']))
+        if restrictions and restrictions != "Без обмежень":
+            potential_concerns.append(f"**{ingredient['display_name']}:** {restrictions}")
+
     for category_name, rules in scoring_rules.items():
         points = 0
-        star_ingredients_found, supporting_ingredients_found, generic_contributors_found = [], [], []
-        for star_rule in rules.get("star_ingredients", []):
-            star_name_lower = star_rule["name"].lower()
-            match = process.extractOne(star_name_lower, ingredient_percentages.keys())
-            if match and match[1] > 95 and ingredient_percentages.get(match[0], 0) >= star_rule["min_effective_percent"]:
+        star_ingredients_found, supporting_ingredients_found = [], []
+        already_scored_names = set()
+        for star_rule in rules.get("star_ingredients", []) if name_scores is not None else []:
+            row = name_scores[rule_rows[star_rule["name"].lower()]]
+            already_scored_names.update(name for name, score in zip(ingredient_names, row) if score > 95)
+            best_col = row.argmax()
+            if row[best_col] > 95 and ingredient_percentages.get(ingredient_names[best_col], 0) >= star_rule["min_effective_percent"]:
                 points += star_rule["points"]
                 star_ingredients_found.append(star_rule["name"])
         supporting_rules = rules.get("supporting_ingredients", {})
-        for ing_name, ing_points in supporting_rules.items():
-            match = process.extractOne(ing_name.lower(), ingredient_percentages.keys())
-            if match and match[1] > 95:
+        for ing_name, ing_points in supporting_rules.items() if name_scores is not None else []:
+            row = name_scores[rule_rows[ing_name.lower()]]
+            already_scored_names.update(name for name, score in zip(ingredient_names, row) if score > 95)
+            if row.max() > 95:
                 points += ing_points
                 supporting_ingredients_found.append(ing_name)
-        generic_function_set = set(rules.get("generic_functions", []))
         bonus_points_per_match = 1.5
-        for ingredient in analyzed_ingredients:
-            ing_name_lower = ingredient['name'].lower()
-            is_already_scored = any(process.extractOne(star['name'].lower(), [ing_name_lower])[1] > 95 for star in rules.get("star_ingredients", [])) or \
-                                any(process.extractOne(sup.lower(), [ing_name_lower])[1] > 95 for sup in supporting_rules.keys())
-            if not is_already_scored and generic_function_set.intersection(set(ingredient.get('functions', []))):
-                points += bonus_points_per_match
-                if ingredient['name'].title() not in generic_contributors_found:
-                    generic_contributors_found.append(ingredient['name'].title())
+        # INCI entries are unique after parsing, so each candidate contributes (and is listed) at most once.
+        generic_contributors_found = [display_name for ingredient_name, display_name in generic_candidates[category_name] if ingredient_name not in already_scored_names]
+        points += bonus_points_per_match * len(generic_contributors_found)
         final_score = round(min(10, (points / rules.get("max_points", 100)) * 10), 1)
         if final_score > 0.5:
             template_set = templates.get(category_name, {})
@@ -319,44 +572,36 @@ def generate_analysis_output(analyzed_ingredients, templates, scoring_rules_data
         if len(top_two_categories) >= 2:
             summary_text = f"**At a Glance:** This product appears to be strongest in **{top_two_categories[0][0]}** and **{top_two_categories[1][0]}**."
             summary_dict = {"Summary": {"score": "", "narrative": summary_text}}; summary_dict.update(ai_says_output); ai_says_output = summary_dict
-    for ing in analyzed_ingredients:
-        match = process.extractOne(ing['name'].lower(), [db_ing['inci_name'].lower() for db_ing in ALL_DATA["ingredients"]])
-        if match and match[1] > 90:
-            db_entry = next((item for item in ALL_DATA["ingredients"] if item['inci_name'].lower() == match[0]), None)
-            if db_entry and db_entry.get("restrictions") and db_entry["restrictions"] != "Без обмежень":
-                 potential_concerns.append(f"**{ing['name'].title()}:** {db_entry['restrictions']}")
-    st.write("**[DEBUG] Stage 5: Narratives and Breakdowns Generated.**")
+    if DEBUG: debug_log.append("**[DEBUG] Stage 5: Narratives and Breakdowns Generated.**")
     return ai_says_output, formula_breakdown, potential_concerns
 
-def find_all_routine_matches(product_roles, analyzed_ingredients, all_data):
-    routine_matches, product_functions = [], {func for ing in analyzed_ingredients for func in ing.get('functions', [])}
+def find_all_routine_matches(product_roles, analyzed_ingredients, product_functions, all_data, debug_log):
+    routine_matches = []
     scoring_config = all_data["scoring_config"]
-    for type_id, skin_type in all_data["skin_types"].items():
-        product_ingredient_set = {ing['name'].lower() for ing in analyzed_ingredients}
-        if any(bad_ing.lower() in product_ingredient_set for bad_ing in skin_type.get('bad_for_ingredients', [])): continue
-        for routine_key, routine_details in all_data["routines"].items():
-            if routine_key.startswith(type_id):
-                for step in routine_details.get("steps", []):
-                    if step["product_function"] in product_roles:
-                        base_score = scoring_config["function_match_scores"]["perfect_match_base_points"]
-                        bonus_points, max_bonus = 0, 0
-                        good_for_list = skin_type.get("good_for_functions", [])
-                        if isinstance(good_for_list, list):
-                            for priority_func in good_for_list:
-                                if isinstance(priority_func, dict):
-                                    func_name, priority = priority_func.get("function"), priority_func.get("priority")
-                                    if func_name and priority:
-                                        bonus_value = scoring_config["priority_fulfillment_scores"].get(f"{priority}_priority_bonus", 0)
-                                        max_bonus += bonus_value
-                                        if func_name in product_functions: bonus_points += bonus_value
-                        total_score = base_score + bonus_points
-                        max_possible_score = base_score + max_bonus
-                        match_percent = (total_score / max_possible_score) * 100 if max_possible_score > 0 else 0
-                        if match_percent >= scoring_config.get("match_thresholds", {}).get("good_match_min_percent", 70):
-                            try:
-                                skin_type_number = type_id.split(' ')[1]
-                                routine_matches.append(f"ID {skin_type_number} Routine {routine_key} Step {step['step_number']} Match {match_percent:.0f}%")
-                            except IndexError: continue
-    st.write(f"**[DEBUG] Stage 6: Routine Matching Complete.** Found **{len(routine_matches)}** placements.")
+    base_score = scoring_config["function_match_scores"]["perfect_match_base_points"]
+    good_match_min_percent = scoring_config.get("match_thresholds", {}).get("good_match_min_percent", 70)
+    # Only the routine steps this product can fill are visited; with none, no skin type can match.
+    steps_by_function = all_data["routine_steps_by_function"]
+    candidate_steps_by_type = {}
+    for _, type_id, routine_key, step_number in sorted(step for func in frozenset(product_roles) for step in steps_by_function.get(func, ())):
+        candidate_steps_by_type.setdefault(type_id, []).append((routine_key, step_number))
+    skin_type_bonuses, skin_type_bad_ingredients = all_data["skin_type_bonuses"], all_data["skin_type_bad_ingredients"]
+    product_ingredient_set = {ing['name'] for ing in analyzed_ingredients}
+    for type_id in all_data["skin_types"]:
+        candidate_steps = candidate_steps_by_type.get(type_id)
+        if not candidate_steps or not skin_type_bad_ingredients[type_id].isdisjoint(product_ingredient_set): continue
+        bonus_pairs, max_bonus = skin_type_bonuses[type_id]
+        # The match score depends only on the skin type and the product, not on the routine step.
+        bonus_points = sum(bonus for func_name, bonus in bonus_pairs if func_name in product_functions)
+        total_score = base_score + bonus_points
+        max_possible_score = base_score + max_bonus
+        match_percent = (total_score / max_possible_score) * 100 if max_possible_score > 0 else 0
+        if match_percent < good_match_min_percent: continue
+        for routine_key, step_number in candidate_steps:
+            try:
+                skin_type_number = type_id.split(' ')[1]
+                routine_matches.append(f"ID {skin_type_number} Routine {routine_key} Step {step_number} Match {match_percent:.0f}%")
+            except IndexError: continue
+    if DEBUG: debug_log.append(f"**[DEBUG] Stage 6: Routine Matching Complete.** Found **{len(routine_matches)}** placements.")
     return routine_matches
 
@@ -0,0 +1,27 @@
+"""
+Builds data/all_data.pkl, a pickled snapshot of the parsed data files and their derived
+lookup indexes, so the app can skip JSON parsing and index building on cold start.
+
+The app refreshes the snapshot itself whenever a data file changes; run this to build it
+ahead of time, e.g. as a deploy step:
+
+    python scripts/build_cache.py
+"""
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    import engine
+
+    signature = engine.data_files_signature()
+    engine.save_all_data_cache(engine.build_all_data(), signature)
+    print(f"Wrote {engine.ALL_DATA_CACHE_PATH}")
+
+
+if __name__ == "__main__":
+    main()